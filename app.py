@@ -1,4 +1,5 @@
-import os, re, sqlite3, stat
+import functools, os, sqlite3, stat, threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, UTC
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
@@ -31,18 +32,62 @@ print(f"[DB] DB_PATH={DB_PATH}")
 print(f"[DB] dir exists? {os.path.isdir(db_dir)}  writable? {os.access(db_dir, os.W_OK)}")
 
 # ---- Data store (SQLite)
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = conn.cursor()
-cur.execute("""
-CREATE TABLE IF NOT EXISTS onboarding_progress (
-  user_id    TEXT NOT NULL,
-  task_id    TEXT NOT NULL,
-  done       INTEGER NOT NULL DEFAULT 0,
-  updated_at TEXT NOT NULL,
-  PRIMARY KEY (user_id, task_id)
-);
-""")
-conn.commit()
+# One connection per thread (Bolt listener threads and the background pool each get
+# their own), so no cursor or connection state is ever shared between threads.
+# WAL lets Home-tab reads proceed while a toggle is being written; busy_timeout makes
+# concurrent writers wait instead of failing immediately with "database is locked"
+_CONN_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA busy_timeout=5000;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-4000;  -- 4MB page cache
+"""
+_tls = threading.local()
+
+def get_conn():
+    c = getattr(_tls, "conn", None)
+    if c is None:
+        c = sqlite3.connect(DB_PATH)
+        c.executescript(_CONN_PRAGMAS)
+        _tls.conn = c
+    return c
+
+def init_db():
+    conn = get_conn()
+    print(f"[DB] journal_mode={conn.execute('PRAGMA journal_mode').fetchone()[0]}")
+    # One row per user; bit i of done_mask is set when TASKS[i] is done (see _TASK_BIT)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_state (
+      user_id    TEXT PRIMARY KEY,
+      done_mask  INTEGER NOT NULL DEFAULT 0,
+      updated_at TEXT NOT NULL
+    );
+    """)
+    _migrate_onboarding_progress(conn)
+    # Refresh planner stats if they're missing or stale (cheap no-op otherwise)
+    conn.execute("PRAGMA optimize")
+
+# One-time copy from the old one-row-per-(user, task) onboarding_progress table. It runs
+# while user_state is still empty; the old table is left in place (no longer read or
+# written) and can be dropped once the migration has been checked.
+def _migrate_onboarding_progress(conn):
+    has_old = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='onboarding_progress'"
+    ).fetchone()
+    if not has_old or conn.execute("SELECT 1 FROM user_state LIMIT 1").fetchone():
+        return
+    bits_values = ",".join("(?,?)" for _ in _TASK_BIT)
+    with conn:
+        conn.execute(
+            f"WITH bits(task_id, bit) AS (VALUES {bits_values}) "
+            "INSERT INTO user_state(user_id, done_mask, updated_at) "
+            "SELECT p.user_id, SUM(CASE WHEN p.done THEN b.bit ELSE 0 END), MAX(p.updated_at) "
+            "FROM onboarding_progress p JOIN bits b ON b.task_id = p.task_id "
+            "GROUP BY p.user_id",
+            [v for item in _TASK_BIT.items() for v in item]
+        )
+    print(f"[DB] migrated onboarding_progress -> user_state ({conn.execute('SELECT COUNT(*) FROM user_state').fetchone()[0]} users)")
 
 # ===== ONBOARDING RESOURCES (replace placeholders) =====
 RESOURCES = {
@@ -81,144 +126,220 @@ TASKS = [
   {"id": "coffee_chat_3",       "label": "Coffee Chat #3 with a TMS team member",                   "group": "Culture"},
 ]
 
-def ensure_user_rows(user_id: str):
-    now = datetime.now(UTC).isoformat()
-    for t in TASKS:
-        cur.execute(
-            "INSERT OR IGNORE INTO onboarding_progress(user_id, task_id, done, updated_at) VALUES(?,?,0,?)",
-            (user_id, t["id"], now)
-        )
-    conn.commit()
-
-def get_done_set(user_id: str):
-    cur.execute("SELECT task_id FROM onboarding_progress WHERE user_id=? AND done=1", (user_id,))
-    return {row[0] for row in cur.fetchall()}
-
-def set_done_bulk(user_id: str, new_done_ids: set):
-    now = datetime.now(UTC).isoformat()
-    for t in TASKS:
-        is_done = 1 if t["id"] in new_done_ids else 0
-        cur.execute(
-            "UPDATE onboarding_progress SET done=?, updated_at=? WHERE user_id=? AND task_id=?",
-            (is_done, now, user_id, t["id"])
-        )
-    conn.commit()
-
-def group_names_in_order():
-    seen = []
-    for t in TASKS:
-        g = t["group"]
-        if g not in seen:
-            seen.append(g)
-    return seen
-
-def tasks_by_group():
-    groups = {}
-    for t in TASKS:
-        groups.setdefault(t["group"], []).append(t)
-    return groups
-
-def build_home_view(user_id: str):
-    done = get_done_set(user_id)
-    total = len(TASKS)
-    progress_text = f"{len(done)}/{total} completed"
-
-    blocks = [
-        {"type": "header", "text": {"type": "plain_text", "text": "TMS Onboarding Checklist"}},
-        {"type": "section", "text": {"type": "mrkdwn",
-         "text": "Welcome to The Movement Street. Check items as you complete them. Your progress saves automatically."}},
-        {"type": "section", "text": {"type": "mrkdwn", "text": f"*Progress:* {progress_text}"}},
+# ---- Static view pieces (depend only on TASKS/RESOURCES, so build them once at import)
+_TOTAL = len(TASKS)
+_GROUP_ORDER = []   # group names in first-seen order
+_GROUPS = {}        # group name -> its tasks
+for t in TASKS:
+    if t["group"] not in _GROUPS:
+        _GROUP_ORDER.append(t["group"])
+        _GROUPS[t["group"]] = []
+    _GROUPS[t["group"]].append(t)
+
+_OPTIONS_BY_GROUP = {
+    g: [{"text": {"type": "plain_text", "text": t["label"]}, "value": t["id"]} for t in items]
+    for g, items in _GROUPS.items()
+}
 
-    ]
+# Lookups for the toggle handler, keyed by the lowercased group name used in action_ids
+_TASKS_BY_GROUP_KEY = {g.lower(): items for g, items in _GROUPS.items()}
+_TASK_IDS_BY_GROUP_KEY = {k: frozenset(t["id"] for t in v) for k, v in _TASKS_BY_GROUP_KEY.items()}
+
+# Bit for each task in user_state.done_mask, by position in TASKS. Stored masks depend on
+# these positions: add new tasks at the END of TASKS (any group) and never reorder/remove.
+_TASK_BIT = {t["id"]: 1 << i for i, t in enumerate(TASKS)}
+_GROUP_MASK_BY_GROUP_KEY = {k: sum(_TASK_BIT[i] for i in ids) for k, ids in _TASK_IDS_BY_GROUP_KEY.items()}
+
+init_db()
 
-    groups = tasks_by_group()
-    for group_name in group_names_in_order():
-        items = groups[group_name]
-        # Group header with mini count
-        group_done_count = sum(1 for t in items if t["id"] in done)
-        blocks.append({"type": "section",
-                       "text": {"type": "mrkdwn", "text": f"*{group_name}* ({group_done_count}/{len(items)})"}})
-
-        options = [{"text": {"type": "plain_text", "text": t["label"]}, "value": t["id"]} for t in items]
-        initial = [{"text": {"type": "plain_text", "text": t["label"]}, "value": t["id"]}
-                   for t in items if t["id"] in done]
-
-        checkbox_el = {
-            "type": "checkboxes",
-            "action_id": f"task_toggle_{group_name.lower()}",
-            "options": options,
-        }
+_HEADER_BLOCKS = [
+    {"type": "header", "text": {"type": "plain_text", "text": "TMS Onboarding Checklist"}},
+    {"type": "section", "text": {"type": "mrkdwn",
+     "text": "Welcome to The Movement Street. Check items as you complete them. Your progress saves automatically."}},
+]
+
+_resources_md = (
+    f"{RESOURCES['all_team_channel']} • {RESOURCES['announcements_channel']} • "
+    f"<{RESOURCES['handbook_url']}|Handbook> • "
+    f"<{RESOURCES['brand_center_url']}|Brand Center> • "
+    f"<{RESOURCES['pd_recordings_url']}|PD Recordings> • "
+    f"<{RESOURCES['staff_directory_url']}|Staff Directory>"
+)
+_RESOURCES_BLOCK = {"type": "context", "elements": [{"type": "mrkdwn", "text": f"Resources: {_resources_md}"}]}
+
+# Timestamp for updated_at. Handlers take it once per user action and pass it to every
+# write they make, so all rows touched by one action share the same updated_at.
+def utc_now_iso():
+    return datetime.now(UTC).isoformat()
+
+# In-process cache of each user's (done task ids, done counts overall and per group key),
+# kept in step so renders never have to recount. SQLite stays the source of truth:
+# entries are filled on first read and replaced (as a whole tuple) on every write. Done
+# sets are frozensets so they can key the view cache below as-is.
+# Cache hits take no lock. Fills and writes hold that user's lock so a fill can't race
+# a write and go stale; other users (and cache hits) never wait on it.
+_progress_cache: dict[str, tuple[frozenset[str], dict]] = {}
+_user_locks: dict[str, threading.Lock] = {}
+_user_locks_guard = threading.Lock()
+
+def _user_lock(user_id: str, locks: dict = _user_locks):
+    with _user_locks_guard:
+        return locks.setdefault(user_id, threading.Lock())
+
+def _count_done(done: frozenset):
+    per_group = {k: len(ids & done) for k, ids in _TASK_IDS_BY_GROUP_KEY.items()}
+    return {"total": sum(per_group.values()), "per_group": per_group}
+
+# Returns (done task ids, done counts) for a user, loading them on first use
+def get_progress(user_id: str):
+    progress = _progress_cache.get(user_id)
+    if progress is not None:
+        return progress
+    with _user_lock(user_id):
+        progress = _progress_cache.get(user_id)
+        if progress is None:
+            row = get_conn().execute("SELECT done_mask FROM user_state WHERE user_id=?", (user_id,)).fetchone()
+            mask = row[0] if row else 0
+            done = frozenset(tid for tid, bit in _TASK_BIT.items() if mask & bit)
+            progress = _progress_cache[user_id] = (done, _count_done(done))
+        return progress
+
+def set_done_bulk(user_id: str, group_key: str, new_done_ids: set, now: str):
+    # Only the group's bits change; bits for every other task are left untouched
+    group_task_ids = _TASK_IDS_BY_GROUP_KEY[group_key]
+    group_mask = _GROUP_MASK_BY_GROUP_KEY[group_key]
+    set_mask = sum(_TASK_BIT[i] for i in new_done_ids & group_task_ids)
+    conn = get_conn()
+    with _user_lock(user_id):
+        # UPSERT creates the row on a user's first toggle; no row just means nothing done
+        with conn:
+            conn.execute(
+                "INSERT INTO user_state(user_id, done_mask, updated_at) VALUES(?,?,?) "
+                "ON CONFLICT(user_id) DO UPDATE SET done_mask=(done_mask & ~?) | ?, updated_at=excluded.updated_at",
+                (user_id, set_mask, now, group_mask, set_mask)
+            )
+        cached = _progress_cache.get(user_id)
+        if cached is not None:
+            done, counts = cached
+            prev_group_done = done & group_task_ids
+            new_group_done = new_done_ids & group_task_ids
+            # Adjust counts by this group's delta instead of recounting everything
+            delta = len(new_group_done) - len(prev_group_done)
+            _progress_cache[user_id] = (
+                (done - group_task_ids) | new_group_done,  # stays a frozenset
+                {
+                    "total": counts["total"] + delta,
+                    "per_group": {**counts["per_group"], group_key: counts["per_group"][group_key] + delta},
+                },
+            )
+
+# The view depends only on which tasks are done, so users with the same progress share
+# one cached block list. Cached blocks are shared: treat them as read-only.
+# total/group_counts are derived from done, so they don't split the cache further.
+@functools.lru_cache(maxsize=256)
+def _blocks_for_done(done: frozenset, total: int, group_counts: tuple):
+    group_blocks = []
+    for group_name, group_done_count in zip(_GROUP_ORDER, group_counts):
+        options = _OPTIONS_BY_GROUP[group_name]
+        checkbox_el = {"type": "checkboxes", "action_id": f"task_toggle_{group_name.lower()}", "options": options}
         # Only set initial_options if we actually have any (avoids Slack validation error)
+        initial = [o for o in options if o["value"] in done]
         if initial:
             checkbox_el["initial_options"] = initial
+        # Group header with mini count, then its checkboxes
+        group_blocks += [
+            {"type": "section",
+             "text": {"type": "mrkdwn", "text": f"*{group_name}* ({group_done_count}/{len(options)})"}},
+            {"type": "actions", "elements": [checkbox_el]},
+        ]
+
+    return [
+        *_HEADER_BLOCKS,
+        {"type": "section", "text": {"type": "mrkdwn", "text": f"*Progress:* {total}/{_TOTAL} completed"}},
+        *group_blocks,
+        _RESOURCES_BLOCK,
+    ]
 
-        blocks.append({
-            "type": "actions",
-            "elements": [checkbox_el]
-        })
-
-    resources_md = (
-        f"{RESOURCES['all_team_channel']} • {RESOURCES['announcements_channel']} • "
-        f"<{RESOURCES['handbook_url']}|Handbook> • "
-        f"<{RESOURCES['brand_center_url']}|Brand Center> • "
-        f"<{RESOURCES['pd_recordings_url']}|PD Recordings> • "
-        f"<{RESOURCES['staff_directory_url']}|Staff Directory>"
-    )
-    blocks.append({"type": "context", "elements": [{"type": "mrkdwn", "text": f"Resources: {resources_md}"}]})
-
-    return {"type": "home", "blocks": blocks}
+def _home_view(done: frozenset, counts: dict):
+    per_group = counts["per_group"]
+    group_counts = tuple(per_group[g.lower()] for g in _GROUP_ORDER)
+    return {"type": "home", "blocks": list(_blocks_for_done(done, counts["total"], group_counts))}
 
 app = App(token=BOT_TOKEN)  # Socket Mode -> no signing secret needed
 
-# Publish checklist when a user opens the App Home
-@app.event("app_home_opened")
-def handle_home_opened(event, client, logger):
-    user_id = event["user"]
-    ensure_user_rows(user_id)
-    client.views_publish(user_id=user_id, view=build_home_view(user_id))
-
-# Auto-setup when someone joins the workspace
-@app.event("team_join")
-def handle_team_join(event, client, logger):
-    user_id = event["user"]["id"]
-    ensure_user_rows(user_id)
+# Slack API calls (views_publish etc.) run here so a slow Slack response doesn't hold
+# up Bolt's listener threads and other users' events
+_pool = ThreadPoolExecutor(max_workers=8)
+
+def run_in_background(logger, fn, *args):
+    def _run():
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception(f"[BG] {fn.__name__} failed")
+    _pool.submit(_run)
+
+# Done set behind each user's last published Home view. The view is a pure function of
+# the done set, so an equal set means Slack already shows exactly this view.
+# Publishes for one user are serialized (read -> publish -> record) so Slack always ends
+# up with the view recorded here, even when pool workers handle rapid toggles at once.
+_last_published: dict[str, frozenset[str]] = {}
+_publish_locks: dict[str, threading.Lock] = {}
+
+def publish_home(client, user_id: str, force: bool = False):
+    with _user_lock(user_id, _publish_locks):
+        done, counts = get_progress(user_id)
+        if not force and _last_published.get(user_id) == done:
+            return
+        client.views_publish(user_id=user_id, view=_home_view(done, counts))
+        _last_published[user_id] = done
+
+def welcome_new_member(client, user_id: str):
     client.chat_postMessage(
         channel=user_id,
         text=("Welcome to TMS. Open the app’s *Home* tab to see your onboarding checklist. "
               "If you have questions, reply here.")
     )
-    client.views_publish(user_id=user_id, view=build_home_view(user_id))
-
-# Save checkbox changes for any group (regex matches all action_ids like task_toggle_paperwork, etc.)
-@app.action(re.compile(r"^task_toggle_"))
-def handle_toggle_any_group(ack, body, client, logger):
-    ack()
-    user_id = body["user"]["id"]
-    action_id = body["actions"][0]["action_id"]  # e.g., task_toggle_paperwork
-    group_key = action_id.replace("task_toggle_", "", 1)  # 'paperwork', 'integration', 'workflow', 'culture'
-
-    # Which tasks belong to this group?
-    group_tasks = [t for t in TASKS if t["group"].lower() == group_key]
-    group_task_ids = {t["id"] for t in group_tasks}
+    publish_home(client, user_id)
 
-    # What did the user just select in this group?
-    selected_ids = {opt["value"] for opt in body["actions"][0].get("selected_options", [])}
-
-    # Merge: keep current done outside this group, replace state for this group
-    current_done = get_done_set(user_id)
-    new_done = (current_done - group_task_ids) | selected_ids
+# Publish checklist when a user opens the App Home
+@app.event("app_home_opened")
+def handle_home_opened(event, client, logger):
+    run_in_background(logger, publish_home, client, event["user"])
 
-    ensure_user_rows(user_id)
-    set_done_bulk(user_id, new_done)
-    client.views_publish(user_id=user_id, view=build_home_view(user_id))
+# Auto-setup when someone joins the workspace
+@app.event("team_join")
+def handle_team_join(event, client, logger):
+    run_in_background(logger, welcome_new_member, client, event["user"]["id"])
+
+# Save checkbox changes: one exact-match listener per group action_id
+# (task_toggle_paperwork, task_toggle_integration, ...), each bound to its group key
+def make_toggle_handler(group_key: str):
+    def handle_toggle(ack, body, client, logger):
+        ack()
+        now = utc_now_iso()
+        user_id = body["user"]["id"]
+
+        # What did the user just select in this group?
+        selected_ids = {opt["value"] for opt in body["actions"][0].get("selected_options", [])}
+
+        # Replace state for this group only; other groups' bits stay as they are.
+        # The write is a few ms, so it stays inline; only the Slack round-trip is pushed
+        # to the background. (Bolt runs listeners concurrently, so two rapid clicks on
+        # the same group may still be saved in either order.)
+        set_done_bulk(user_id, group_key, selected_ids, now)
+        run_in_background(logger, publish_home, client, user_id)
+    return handle_toggle
+
+for _group_key in _TASKS_BY_GROUP_KEY:
+    app.action(f"task_toggle_{_group_key}")(make_toggle_handler(_group_key))
 
 # Optional helper slash command to refresh your own view
 @app.command("/onboard")
-def cmd_onboard(ack, body, client):
+def cmd_onboard(ack, body, client, logger):
     ack("Opening your checklist in the App Home.")
-    user_id = body["user_id"]
-    ensure_user_rows(user_id)
-    client.views_publish(user_id=user_id, view=build_home_view(user_id))
+    # Explicit refresh: republish even if we think Slack already has this view
+    run_in_background(logger, publish_home, client, body["user_id"], True)
 
 if __name__ == "__main__":
     SocketModeHandler(app, APP_TOKEN).start()